@@ -2,10 +2,14 @@ import streamlit as st
 import random
 import os
 import tempfile
-import shutil
-from datetime import datetime, timedelta
+import html
+import string
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import json
-import threading
+import sqlite3
+import time
 
 # Configure page
 st.set_page_config(
@@ -14,122 +18,256 @@ st.set_page_config(
     layout="wide"
 )
 
-# Global file to store PIN-to-file mappings
+# Global database to store PIN-to-file mappings
 STORAGE_DIR = os.path.join(tempfile.gettempdir(), "streamlit_file_transfer")
-METADATA_FILE = os.path.join(STORAGE_DIR, "file_metadata.json")
+DB_PATH = os.path.join(STORAGE_DIR, "file_metadata.db")
+# Metadata file used before the SQLite store; imported once, then removed
+LEGACY_METADATA_FILE = os.path.join(STORAGE_DIR, "file_metadata.json")
+
+# Files expire this many seconds after upload
+EXPIRY_SECONDS = 24 * 60 * 60
+
+# Minimum number of seconds between expiry sweeps
+CLEANUP_INTERVAL_SECONDS = 60
+
+# Upper bound on threads writing a multi-file upload to disk
+MAX_UPLOAD_WORKERS = 8
+
+# Icons for the File Details list, keyed on the MIME type before the "/"
+FILE_TYPE_ICONS = {
+    'image': "🖼️",
+    'video': "🎥",
+    'audio': "🎵",
+}
+DEFAULT_FILE_ICON = "📄"
+
+# Card shown for each uploaded file, filled in with $filename, $size (KB) and $pin
+PIN_CARD_TEMPLATE = string.Template("""
+<div style='
+    background: linear-gradient(45deg, #FF6B6B, #4ECDC4);
+    padding: 15px;
+    border-radius: 8px;
+    margin: 10px 0;
+    width: 66%;
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+'>
+    <div>
+        <h4 style='color: white; margin: 0; font-size: 1.1em;'>$filename</h4>
+        <p style='color: rgba(255,255,255,0.8); margin: 5px 0 0 0; font-size: 0.9em;'>$size KB</p>
+    </div>
+    <div style='text-align: center;'>
+        <h2 style='color: white; margin: 0; font-size: 2em; letter-spacing: 0.1em;'>$pin</h2>
+        <p style='color: white; margin: 0; font-size: 0.8em;'>PIN</p>
+    </div>
+</div>
+""")
+
+# Every valid 4-digit PIN
+PIN_POOL = frozenset(f"{i:04d}" for i in range(1000, 10000))
 
 # Create storage directory if it doesn't exist
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
-# Thread lock for file operations
-file_lock = threading.Lock()
+# Streamlit re-executes this script on every rerun, so the connection is
+# created once and shared between reruns and sessions. It is only used for
+# reads; writes go through _connect_for_write
+@st.cache_resource
+def get_db_connection():
+    """Open the shared read connection and create the schema if needed"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while a write is in progress
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transfers (
+            pin TEXT PRIMARY KEY,
+            filename TEXT,
+            filepath TEXT,
+            size INTEGER,
+            upload_ts REAL,
+            type TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transfers_upload_ts ON transfers (upload_ts)")
+    _import_legacy_metadata()
+    return conn
 
-def load_file_metadata():
-    """Load file metadata from persistent storage"""
-    try:
-        if os.path.exists(METADATA_FILE):
-            with open(METADATA_FILE, 'r') as f:
-                data = json.load(f)
-                # Convert string timestamps back to datetime objects
-                for pin, info in data.items():
-                    if isinstance(info['upload_time'], str):
-                        info['upload_time'] = datetime.fromisoformat(info['upload_time'])
-                return data
-        return {}
-    except Exception as e:
-        st.error(f"Error loading metadata: {e}")
-        return {}
+def _connect_for_write():
+    """Open a short-lived connection for writes that must not share state with other sessions"""
+    return sqlite3.connect(DB_PATH, timeout=30)
 
-def save_file_metadata(metadata):
-    """Save file metadata to persistent storage"""
+def _import_legacy_metadata():
+    """Move PINs from the old JSON metadata file into the database"""
     try:
-        with file_lock:
-            # Convert datetime objects to strings for JSON serialization
-            serializable_data = {}
-            for pin, info in metadata.items():
-                serializable_info = info.copy()
-                if isinstance(serializable_info['upload_time'], datetime):
-                    serializable_info['upload_time'] = serializable_info['upload_time'].isoformat()
-                serializable_data[pin] = serializable_info
-            
-            with open(METADATA_FILE, 'w') as f:
-                json.dump(serializable_data, f, indent=2)
-    except Exception as e:
-        st.error(f"Error saving metadata: {e}")
+        with open(LEGACY_METADATA_FILE, 'r') as f:
+            data = json.load(f)
+        rows = [
+            (pin, info['filename'], info['filepath'], info['size'],
+             datetime.fromisoformat(info['upload_time']).timestamp(), info['type'])
+            for pin, info in data.items()
+        ]
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError) as e:
+        st.error(f"Error importing old metadata: {e}")
+        return
+    
+    with closing(_connect_for_write()) as write_conn:
+        with write_conn:
+            for row in rows:
+                cursor = write_conn.execute(
+                    "INSERT OR IGNORE INTO transfers (pin, filename, filepath, size, upload_ts, type) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    row
+                )
+                if not cursor.rowcount:
+                    # PIN already taken in the database; the sweep would never find this file
+                    try:
+                        os.remove(row[2])
+                    except OSError:
+                        pass  # File might already be deleted
+    os.remove(LEGACY_METADATA_FILE)
+
+def reserve_pins(count):
+    """Reserve up to count random, unused 4-digit PINs in one transaction"""
+    with closing(_connect_for_write()) as write_conn:
+        with write_conn:
+            # Take the write lock before reading the used PINs so no other
+            # session can claim one of the picks before they are inserted
+            write_conn.execute("BEGIN IMMEDIATE")
+            used_pins = {pin for (pin,) in write_conn.execute("SELECT pin FROM transfers")}
+            free_pins = tuple(PIN_POOL - used_pins)
+            pins = random.sample(free_pins, min(count, len(free_pins)))
+            upload_ts = time.time()
+            write_conn.executemany(
+                "INSERT INTO transfers (pin, upload_ts) VALUES (?, ?)",
+                [(pin, upload_ts) for pin in pins]
+            )
+    return pins
 
-def generate_pin():
-    """Generate a random 4-digit PIN"""
-    metadata = load_file_metadata()
-    while True:
-        pin = f"{random.randint(1000, 9999)}"
-        if pin not in metadata:  # Ensure PIN is unique
-            return pin
+def release_pin(pin):
+    """Forget a PIN and its file information"""
+    with closing(_connect_for_write()) as write_conn:
+        with write_conn:
+            write_conn.execute("DELETE FROM transfers WHERE pin = ?", (pin,))
 
-def save_file_with_pin(uploaded_file, pin):
-    """Save uploaded file with PIN as identifier"""
+def _write_file_bytes(pin, uploaded_file):
+    """Write an uploaded file to disk under a PIN reserved by reserve_pins"""
     try:
         # Save file with PIN as filename prefix
         file_path = os.path.join(STORAGE_DIR, f"{pin}_{uploaded_file.name}")
         
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        # Load existing metadata
-        metadata = load_file_metadata()
-        
-        # Add new file info
-        metadata[pin] = {
-            'filename': uploaded_file.name,
-            'filepath': file_path,
-            'size': uploaded_file.size,
-            'upload_time': datetime.now(),
-            'type': uploaded_file.type
-        }
-        
-        # Save updated metadata
-        save_file_metadata(metadata)
+        # Streamlit's UploadedFile is an in-memory BytesIO, so write its
+        # buffer straight to the file without any intermediate copies
+        with open(file_path, "wb") as f, uploaded_file.getbuffer() as view:
+            f.write(view)
         
         return file_path
     except Exception as e:
+        release_pin(pin)
         raise Exception(f"Failed to save file: {str(e)}")
 
+def _save_upload(pin, uploaded_file):
+    """Write one upload to disk and return (entry, failure); runs in worker threads"""
+    try:
+        file_path = _write_file_bytes(pin, uploaded_file)
+    except Exception as e:
+        return None, {'filename': uploaded_file.name, 'error': str(e)}
+    return {
+        'filename': uploaded_file.name,
+        'filepath': file_path,
+        'pin': pin,
+        'size': uploaded_file.size,
+        'type': uploaded_file.type
+    }, None
+
+def _add_metadata_entries(entries):
+    """Fill in the reserved rows for a batch of saved files in one transaction"""
+    upload_ts = time.time()
+    # A short-lived connection keeps this transaction apart from statements other
+    # sessions run on the shared one; SQLite's own locking serializes writers
+    try:
+        with closing(_connect_for_write()) as write_conn:
+            with write_conn:
+                write_conn.executemany(
+                    "UPDATE transfers SET filename = ?, filepath = ?, size = ?, upload_ts = ?, type = ? WHERE pin = ?",
+                    [
+                        (entry['filename'], entry['filepath'], entry['size'], upload_ts, entry['type'], entry['pin'])
+                        for entry in entries
+                    ]
+                )
+    except Exception:
+        # Without their rows the files would never be cleaned up, so undo the batch
+        for entry in entries:
+            try:
+                os.remove(entry['filepath'])
+            except OSError:
+                pass  # File might already be deleted
+        for entry in entries:
+            try:
+                release_pin(entry['pin'])
+            except sqlite3.Error:
+                pass  # The empty reservation expires with the next sweep
+        raise
+
 def get_file_by_pin(pin):
-    """Retrieve file information by PIN"""
-    metadata = load_file_metadata()
-    return metadata.get(pin)
+    """Retrieve file information by PIN, ignoring expired files"""
+    # Enforce expiry here; the throttled sweep only reclaims disk space
+    row = get_db_connection().execute(
+        "SELECT filename, filepath, size, upload_ts, type FROM transfers "
+        "WHERE pin = ? AND filepath IS NOT NULL AND upload_ts >= ?",
+        (pin, time.time() - EXPIRY_SECONDS)
+    ).fetchone()
+    return dict(row) if row else None
 
 def cleanup_old_files():
     """Clean up files older than 24 hours"""
     try:
-        metadata = load_file_metadata()
-        current_time = datetime.now()
-        pins_to_remove = []
+        conn = get_db_connection()
+        cutoff = time.time() - EXPIRY_SECONDS
         
-        for pin, file_info in metadata.items():
-            if current_time - file_info['upload_time'] > timedelta(hours=24):
-                # Remove file from disk
-                if os.path.exists(file_info['filepath']):
-                    try:
-                        os.remove(file_info['filepath'])
-                    except OSError:
-                        pass  # File might already be deleted
-                pins_to_remove.append(pin)
+        expired = conn.execute(
+            "SELECT filepath FROM transfers WHERE upload_ts < ?", (cutoff,)
+        ).fetchall()
         
-        # Remove expired entries from metadata
-        for pin in pins_to_remove:
-            del metadata[pin]
+        # Remove expired entries from the database
+        if expired:
+            with closing(_connect_for_write()) as write_conn:
+                with write_conn:
+                    write_conn.execute("DELETE FROM transfers WHERE upload_ts < ?", (cutoff,))
         
-        # Save updated metadata
-        if pins_to_remove:
-            save_file_metadata(metadata)
+        for row in expired:
+            # Remove file from disk (unfinished reservations have no file)
+            if row['filepath']:
+                try:
+                    os.remove(row['filepath'])
+                except OSError:
+                    pass  # File might already be deleted
             
-        return len(pins_to_remove)
+        return len(expired)
     except Exception as e:
         st.error(f"Error during cleanup: {e}")
         return 0
 
-# Clean up old files on app start
-cleanup_old_files()
+@st.cache_resource
+def _get_cleanup_state():
+    """When the last expiry sweep ran, shared across reruns and sessions"""
+    return {'last_run': 0.0}
+
+def cleanup_old_files_if_due():
+    """Run cleanup_old_files at most once per CLEANUP_INTERVAL_SECONDS"""
+    state = _get_cleanup_state()
+    now = time.time()
+    if now - state['last_run'] < CLEANUP_INTERVAL_SECONDS:
+        return 0
+    state['last_run'] = now
+    return cleanup_old_files()
+
+# Clean up old files on app start. Streamlit reruns the whole script on
+# every interaction, so throttle the sweep rather than running it each time
+cleanup_old_files_if_due()
 
 # App title and description
 st.title("🔒 Secure File Transfer")
@@ -174,17 +312,9 @@ with tab1:
                 with col3:
                     st.write(file.type or "Unknown")
                 with col4:
-                    # Show file icon based on type
-                    if file.type and file.type.startswith('image/'):
-                        st.write("🖼️")
-                    elif file.type and file.type.startswith('video/'):
-                        st.write("🎥")
-                    elif file.type and file.type.startswith('audio/'):
-                        st.write("🎵")
-                    elif file.type and 'pdf' in file.type.lower():
-                        st.write("📄")
-                    else:
-                        st.write("📄")
+                    # Show file icon based on the MIME type's top-level part
+                    mime_prefix = (file.type or "").split("/", 1)[0]
+                    st.write(FILE_TYPE_ICONS.get(mime_prefix, DEFAULT_FILE_ICON))
         
         # Generate PINs button
         if st.button("🔐 Generate PINs & Upload All Files", type="primary", use_container_width=True):
@@ -193,19 +323,24 @@ with tab1:
                     uploaded_file_info = []
                     failed_uploads = []
                     
-                    # Process each file
-                    for file in uploaded_files:
-                        try:
-                            pin = generate_pin()
-                            file_path = save_file_with_pin(file, pin)
-                            uploaded_file_info.append({
-                                'filename': file.name,
-                                'pin': pin,
-                                'size': file.size,
-                                'type': file.type
-                            })
-                        except Exception as e:
-                            failed_uploads.append({'filename': file.name, 'error': str(e)})
+                    # Reserve all PINs up front so the worker threads never race for them
+                    pins = reserve_pins(len(uploaded_files))
+                    files_to_save = uploaded_files[:len(pins)]
+                    for file in uploaded_files[len(pins):]:
+                        failed_uploads.append({'filename': file.name, 'error': "No free PINs available, please try again later"})
+                    
+                    # Write the files to disk concurrently
+                    if files_to_save:
+                        with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, len(files_to_save))) as executor:
+                            for entry, failure in executor.map(_save_upload, pins, files_to_save):
+                                if entry:
+                                    uploaded_file_info.append(entry)
+                                else:
+                                    failed_uploads.append(failure)
+                    
+                    # Record all successful uploads with a single metadata write
+                    if uploaded_file_info:
+                        _add_metadata_entries(uploaded_file_info)
                     
                     # Show results
                     if uploaded_file_info:
@@ -215,34 +350,18 @@ with tab1:
                         st.markdown("---")
                         st.subheader("🔑 Your File PINs")
                         
-                        # Create a nice layout for PINs
-                        for i, file_info in enumerate(uploaded_file_info):
-                            col1, col2 = st.columns([2, 1])
-                            
-                            with col1:
-                                st.markdown(
-                                    f"""
-                                    <div style='
-                                        background: linear-gradient(45deg, #FF6B6B, #4ECDC4);
-                                        padding: 15px;
-                                        border-radius: 8px;
-                                        margin: 10px 0;
-                                        display: flex;
-                                        justify-content: space-between;
-                                        align-items: center;
-                                    '>
-                                        <div>
-                                            <h4 style='color: white; margin: 0; font-size: 1.1em;'>{file_info['filename']}</h4>
-                                            <p style='color: rgba(255,255,255,0.8); margin: 5px 0 0 0; font-size: 0.9em;'>{file_info['size']/1024:.1f} KB</p>
-                                        </div>
-                                        <div style='text-align: center;'>
-                                            <h2 style='color: white; margin: 0; font-size: 2em; letter-spacing: 0.1em;'>{file_info['pin']}</h2>
-                                            <p style='color: white; margin: 0; font-size: 0.8em;'>PIN</p>
-                                        </div>
-                                    </div>
-                                    """,
-                                    unsafe_allow_html=True
+                        # Render every PIN card in a single markdown element
+                        st.markdown(
+                            "".join(
+                                PIN_CARD_TEMPLATE.substitute(
+                                    filename=html.escape(file_info['filename']),
+                                    size=f"{file_info['size'] / 1024:.1f}",
+                                    pin=file_info['pin']
                                 )
+                                for file_info in uploaded_file_info
+                            ),
+                            unsafe_allow_html=True
+                        )
                         
                         # Summary box with all PINs for easy copying
                         with st.expander("📋 Copy All PINs", expanded=False):
@@ -275,59 +394,52 @@ with tab2:
             help="Enter the PIN provided by the file sender"
         )
     
-    if pin_input:
-        if len(pin_input) == 4 and pin_input.isdigit():
-            with st.spinner("Verifying PIN..."):
-                file_info = get_file_by_pin(pin_input)
-                
-                if file_info:
-                    # Check if file still exists on disk
-                    if os.path.exists(file_info['filepath']):
-                        # Display file information
-                        st.success("✅ PIN verified! File found.")
-                        
-                        col1, col2, col3, col4 = st.columns(4)
-                        with col1:
-                            st.metric("File Name", file_info['filename'])
-                        with col2:
-                            st.metric("File Size", f"{file_info['size'] / 1024:.1f} KB")
-                        with col3:
-                            st.metric("File Type", file_info['type'] or "Unknown")
-                        with col4:
-                            time_remaining = 24 - int((datetime.now() - file_info['upload_time']).total_seconds() / 3600)
-                            st.metric("Expires in", f"{max(0, time_remaining)} hours")
-                        
-                        # Download button
-                        try:
-                            with open(file_info['filepath'], 'rb') as file:
-                                file_data = file.read()
-                            
-                            st.download_button(
-                                label="📥 Download File",
-                                data=file_data,
-                                file_name=file_info['filename'],
-                                mime=file_info['type'],
-                                type="primary",
-                                use_container_width=True
-                            )
-                            
-                        except Exception as e:
-                            st.error(f"Error reading file: {str(e)}")
-                            st.info("The file might have been corrupted or is no longer accessible.")
-                    else:
-                        st.error("❌ File not found on disk.")
-                        st.info("The file may have been moved or deleted from storage.")
-                        # Clean up metadata for missing file
-                        metadata = load_file_metadata()
-                        if pin_input in metadata:
-                            del metadata[pin_input]
-                            save_file_metadata(metadata)
-                else:
-                    st.error("❌ Invalid PIN or file has expired.")
-                    st.info("Please check the PIN or contact the file sender.")
+    # Validate the format first; the lookup itself is a single indexed query,
+    # cheap enough to run without a spinner on every keystroke rerun
+    if pin_input and len(pin_input) == 4 and pin_input.isdigit():
+        file_info = get_file_by_pin(pin_input)
+        
+        if file_info:
+            try:
+                # Opening the file doubles as the existence check
+                with open(file_info['filepath'], 'rb') as file:
+                    # Display file information
+                    st.success("✅ PIN verified! File found.")
+                    
+                    col1, col2, col3, col4 = st.columns(4)
+                    with col1:
+                        st.metric("File Name", file_info['filename'])
+                    with col2:
+                        st.metric("File Size", f"{file_info['size'] / 1024:.1f} KB")
+                    with col3:
+                        st.metric("File Type", file_info['type'] or "Unknown")
+                    with col4:
+                        time_remaining = EXPIRY_SECONDS // 3600 - int((time.time() - file_info['upload_ts']) // 3600)
+                        st.metric("Expires in", f"{max(0, time_remaining)} hours")
+                    
+                    # Download button; Streamlit reads the open file itself
+                    st.download_button(
+                        label="📥 Download File",
+                        data=file,
+                        file_name=file_info['filename'],
+                        mime=file_info['type'],
+                        type="primary",
+                        use_container_width=True
+                    )
+            
+            except FileNotFoundError:
+                st.error("❌ File not found on disk.")
+                st.info("The file may have been moved or deleted from storage.")
+                # Clean up metadata for missing file
+                release_pin(pin_input)
+            except Exception as e:
+                st.error(f"Error reading file: {str(e)}")
+                st.info("The file might have been corrupted or is no longer accessible.")
         else:
-            if pin_input:  # Only show error if user has entered something
-                st.warning("Please enter a valid 4-digit PIN")
+            st.error("❌ Invalid PIN or file has expired.")
+            st.info("Please check the PIN or contact the file sender.")
+    elif pin_input:  # Only show error if user has entered something
+        st.warning("Please enter a valid 4-digit PIN")
 
 with tab3:
     st.header("How It Works")